@@ -1,5 +1,8 @@
 # app/__init__.py
 
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from flask import Flask
 from flask_cors import CORS
 
@@ -11,6 +14,24 @@ def create_app():
     # All of our configuration is in a separate file
     app.config.from_pyfile('../config.py')
 
+    # Must be set before Tesseract is loaded or spawned
+    os.environ.setdefault('OMP_THREAD_LIMIT', str(app.config['TESSERACT_THREAD_LIMIT']))
+
+    # OCR runs in separate processes so request threads only wait on it.
+    # 'spawn' avoids forking the threaded server.
+    from . import services
+    app.extensions['ocr_pool'] = ProcessPoolExecutor(
+        max_workers=app.config['OCR_WORKERS'],
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=services.init_ocr_worker,
+        initargs=(app.config['TESSERACT_THREAD_LIMIT'],)
+    )
+
+    # The front page never changes while the server runs, so read it once
+    with open(os.path.join(app.static_folder, 'index.html'), 'rb') as f:
+        index_bytes = f.read()
+    app.extensions['index_page'] = (index_bytes, services.content_digest(index_bytes))
+
     with app.app_context():
         # Import and register the routes (our API endpoints)
         from . import routes
@@ -1,15 +1,166 @@
 # app/routes.py
 
 import os
-from flask import Blueprint, request, jsonify, send_from_directory, current_app
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from flask import Blueprint, request, jsonify, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
 from . import services
 
 main_bp = Blueprint('main_bp', __name__)
 
+# LRU cache of extracted text, keyed by (content digest, extension, crop)
+_OCR_CACHE = OrderedDict()
+_OCR_CACHE_LOCK = threading.Lock()
+
+
+def _get_cached_text(key):
+    """Returns cached OCR text for the key and marks it recently used, or None."""
+    with _OCR_CACHE_LOCK:
+        text = _OCR_CACHE.get(key)
+        if text is not None:
+            _OCR_CACHE.move_to_end(key)
+        return text
+
+
+def _cache_text(key, text):
+    """Stores OCR text, evicting the least recently used entries past OCR_CACHE_SIZE."""
+    max_size = current_app.config['OCR_CACHE_SIZE']
+    with _OCR_CACHE_LOCK:
+        _OCR_CACHE[key] = text
+        _OCR_CACHE.move_to_end(key)
+        while len(_OCR_CACHE) > max_size:
+            _OCR_CACHE.popitem(last=False)
+
+
+@main_bp.app_errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    """Rejects uploads over MAX_CONTENT_LENGTH with a JSON error."""
+    max_mb = current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return jsonify({'error': f'File is too large (max {max_mb} MB)'}), 413
+
+
 @main_bp.route('/')
 def index():
-    """Serves the index.html file from the static folder."""
-    return send_from_directory(current_app.static_folder, 'index.html')
+    """Serves index.html from memory, answering 304 when the client's copy is current."""
+    body, etag = current_app.extensions['index_page']
+    response = current_app.response_class(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
+
+
+def _read_naming_options():
+    """Reads the naming options that apply to every file in the request."""
+    # Get the user's component selections, dropping duplicates but keeping their order
+    component_list_str = request.form.get('component_list', '')
+    component_list = list(dict.fromkeys(
+        c for c in (c.strip() for c in component_list_str.split(',')) if c
+    ))
+
+    return {
+        'custom_prefix': request.form.get('custom_prefix', '').strip(),
+        'separator': request.form.get('separator', '_'),
+        'custom_search_term': request.form.get('custom_search_term', '').strip(),
+        'targeted_label_term': request.form.get('targeted_label_term', '').strip(),
+        'component_list': component_list,
+    }
+
+
+def _start_ocr(file, original_ext, component_list):
+    """
+    Reads an uploaded file and starts its OCR in the pool, unless its text is cached.
+
+    Returns:
+        tuple: The cache key, and the cached text or a Future for it
+    """
+    # Only scan as much of the page as the selected components need
+    crop_top_percent = services.calculate_adaptive_crop(component_list)
+
+    # Read the upload once so identical files can be served from the cache
+    file_bytes = file.read()
+    cache_key = (services.content_digest(file_bytes), original_ext, crop_top_percent)
+
+    extracted_text = _get_cached_text(cache_key)
+    if extracted_text is not None:
+        return cache_key, extracted_text
+
+    # Process the file in the OCR pool
+    future = current_app.extensions['ocr_pool'].submit(
+        services.process_file_bytes,
+        file_bytes,
+        original_ext,
+        crop_top_percent=crop_top_percent,
+        char_whitelist=current_app.config['TESSERACT_CHAR_WHITELIST'],
+        binarize=current_app.config['OCR_BINARIZE']
+    )
+    return cache_key, future
+
+
+def _ocr_deadline():
+    """Returns the time.monotonic() by which OCR started now must be done."""
+    return time.monotonic() + current_app.config['OCR_TIMEOUT']
+
+
+def _finish_rename(file, original_ext, options, cache_key, pending, deadline):
+    """
+    Waits for a file's OCR if needed and builds its suggested name.
+
+    Args:
+        deadline: time.monotonic() after which the OCR is cancelled and
+            FutureTimeoutError raised, shared by every file of a request
+
+    Returns:
+        dict: The original name, extracted text, suggested name and metadata
+    """
+    original_filename = file.filename
+    component_list = options['component_list']
+
+    if isinstance(pending, Future):
+        try:
+            extracted_text = pending.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            # Nobody will read the result, so don't let a queued job tie up a worker
+            pending.cancel()
+            raise
+        _cache_text(cache_key, extracted_text)
+    else:
+        extracted_text = pending
+
+    current_app.logger.debug("Tesseract output: %d chars", len(extracted_text))
+
+    # Extract original filename without extension for the component
+    original_name_only = os.path.splitext(original_filename)[0]
+
+    # Extract metadata with both search terms, only searching for the selected components
+    metadata = services.extract_metadata(
+        extracted_text, options['custom_search_term'], options['targeted_label_term'],
+        fields=set(component_list) | {'vendor'}
+    )
+
+    # Add original filename to metadata
+    metadata['original_filename'] = original_name_only
+
+    # Create suggested filename
+    suggested_name = services.create_suggested_name(
+        metadata, original_ext, options['custom_prefix'], options['separator'], component_list
+    )
+
+    return {
+        'original_name': original_filename,
+        'extracted_text': extracted_text,
+        'suggested_name': suggested_name,
+        'metadata': metadata
+    }
+
+
+def _rename_file(file, original_ext, options):
+    """Runs OCR on one uploaded file and builds its suggested name."""
+    cache_key, pending = _start_ocr(file, original_ext, options['component_list'])
+    return _finish_rename(file, original_ext, options, cache_key, pending, _ocr_deadline())
 
 
 @main_bp.route('/ocr-rename', methods=['POST'])
@@ -21,54 +172,60 @@ def ocr_rename():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    try:
-        # Get the original filename and extension
-        original_filename = file.filename
-        _, original_ext = os.path.splitext(original_filename.lower())
-        
-        # Get the raw configuration from the form
-        custom_prefix = request.form.get('custom_prefix', '').strip()
-        separator = request.form.get('separator', '_')
-        
-        # Get custom search terms
-        custom_search_term = request.form.get('custom_search_term', '').strip()
-        targeted_label_term = request.form.get('targeted_label_term', '').strip()
-        
-        # Get the user's component selections
-        component_list_str = request.form.get('component_list', '')
-        component_list = [c.strip() for c in component_list_str.split(',') if c.strip()]
-        
-        # Extract original filename without extension for the component
-        original_name_only = os.path.splitext(original_filename)[0]
-        
-        # Process the file using the service WITH FORCED 100% SCAN FOR DEBUGGING
-        extracted_text = services.process_file_stream(
-            file.stream, 
-            original_ext,
-            crop_top_percent=100,  # FORCE FULL SCAN
-            component_list=component_list
-        )
-        
-        # Debugging print statement
-        print("----- TESSERACT RAW OUTPUT -----\n", extracted_text, "\n------------------------------")
-        
-        # Extract metadata with both search terms
-        metadata = services.extract_metadata(extracted_text, custom_search_term, targeted_label_term)
-        
-        # Add original filename to metadata
-        metadata['original_filename'] = original_name_only
-        
-        # Create suggested filename
-        suggested_name = services.create_suggested_name(
-            metadata, original_ext, custom_prefix, separator, component_list
-        )
-
-        return jsonify({
-            'original_name': original_filename,
-            'extracted_text': extracted_text,
-            'suggested_name': suggested_name,
-            'metadata': metadata
-        })
+    # Reject unsupported types before reading the upload into memory
+    _, original_ext = os.path.splitext(file.filename.lower())
+    if original_ext not in services.SUPPORTED_EXTENSIONS:
+        return jsonify({'error': f'Unsupported file type: {original_ext}'}), 415
 
+    try:
+        return jsonify(_rename_file(file, original_ext, _read_naming_options()))
+    except FutureTimeoutError:
+        return jsonify({'error': 'OCR timed out'}), 504
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+
+
+@main_bp.route('/ocr-rename-batch', methods=['POST'])
+def ocr_rename_batch():
+    """
+    Renames every file sent as 'files' using the same naming options.
+    All files are submitted to the OCR pool before waiting on any of them,
+    so they are processed in parallel, and errors are reported per file
+    instead of failing the whole batch. The whole batch shares one
+    OCR_TIMEOUT, and files still unfinished by then are cancelled.
+    """
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return jsonify({'error': 'No files in the request'}), 400
+
+    options = _read_naming_options()
+
+    # Start OCR for every file first; each entry is (file, ext, started OCR or error)
+    started = []
+    for file in files:
+        _, original_ext = os.path.splitext(file.filename.lower())
+        if original_ext not in services.SUPPORTED_EXTENSIONS:
+            started.append((file, original_ext, f'Unsupported file type: {original_ext}'))
+            continue
+
+        try:
+            started.append((file, original_ext, _start_ocr(file, original_ext, options['component_list'])))
+        except Exception as e:
+            started.append((file, original_ext, str(e)))
+
+    # Then collect the results in upload order, all against the same deadline
+    deadline = _ocr_deadline()
+    results = []
+    for file, original_ext, ocr in started:
+        if isinstance(ocr, str):
+            results.append({'original_name': file.filename, 'error': ocr})
+            continue
+
+        try:
+            results.append(_finish_rename(file, original_ext, options, *ocr, deadline))
+        except FutureTimeoutError:
+            results.append({'original_name': file.filename, 'error': 'OCR timed out'})
+        except Exception as e:
+            results.append({'original_name': file.filename, 'error': str(e)})
+
+    return jsonify(results)
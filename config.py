@@ -10,5 +10,37 @@ TESSERACT_CMD = 'tesseract'
 # Language for Tesseract to use
 TESSERACT_LANG = 'eng'
 
+# Characters Tesseract may recognize, or None to allow all of them.
+# A whitelist such as the one below prunes the recognizer's search, but any
+# other character (e.g. '&' or '@') is dropped from the extracted text.
+# Keep the space in it, or words run together.
+# TESSERACT_CHAR_WHITELIST = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789.,/-:$€£# '
+TESSERACT_CHAR_WHITELIST = None
+
+# Threshold pages to black and white before OCR. With False, Tesseract gets
+# the grayscale page and binarizes it itself, which skips a pass here but
+# reads unevenly lit photos and faint print worse.
+OCR_BINARIZE = True
+
+# Number of threads Tesseract (OpenMP) and OpenCV may use per page.
+# Keep this at 1 and scale with more OCR workers instead.
+TESSERACT_THREAD_LIMIT = 1
+
+# Largest upload accepted, in bytes. Bigger requests are rejected with 413
+# before their body is read.
+MAX_CONTENT_LENGTH = 25 * 1024 * 1024
+
+# Number of worker processes that run OCR, so the web server isn't blocked
+# by CPU-bound Tesseract work. Defaults to one per core's worth of threads.
+OCR_WORKERS = max(1, (os.cpu_count() or 1) // TESSERACT_THREAD_LIMIT)
+
+# Seconds to wait for a request's OCR before giving up. A batch shares one
+# deadline, and files still queued when it passes are cancelled.
+OCR_TIMEOUT = 60
+
+# Number of OCR results kept in memory, keyed by file content.
+# Re-uploading the same file (e.g. to try another naming pattern) skips OCR.
+OCR_CACHE_SIZE = 256
+
 # Server URL for auto-opening in the browser
 SERVER_URL = "http://127.0.0.1:5000"
@@ -4,9 +4,11 @@ import webbrowser
 from app import create_app
 from config import SERVER_URL
 
-app = create_app()
-
+# OCR worker processes re-import this file, so the app is only created when
+# it's run directly. WSGI servers load it from wsgi.py instead.
 if __name__ == '__main__':
+    app = create_app()
+
     # Your auto-open feature now lives here
     # We point it to the static index.html file
     webbrowser.open(f"{SERVER_URL}/static/index.html")
@@ -0,0 +1,196 @@
+# tests/test_extract_metadata.py
+
+import contextlib
+import importlib.util
+import io
+import random
+import re
+import sys
+import unittest
+from unittest import mock
+
+from app import services
+
+
+def baseline_extract_metadata(text, custom_search_term=None, targeted_label_term=None):
+    """
+    The original line-by-line extract_metadata, kept as the reference the
+    optimized version must agree with.
+    """
+    date_str = None
+    amount_str = None
+    invoice_str = None
+    reference_str = None
+    custom_match_str = None
+    targeted_label_str = None
+    vendor_str = None
+
+    lines = text.split('\n')
+
+    if lines:
+        first_line = lines[0].strip()
+        vendor_str = re.sub(r'[^a-zA-Z0-9\s-]', '', first_line).strip()[:20].replace(' ', '_')
+    if not vendor_str:
+        vendor_str = "OCR_Scan"
+
+    date_pattern = re.compile(r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}')
+    amount_pattern = re.compile(r'([Ss]?\s*|Total|TOTAL|Amount)\s*[\$€£]?\s*(\d{1,3}(?:[,\.\s]?\d{3})*(?:[\.,]\d{2}))', re.IGNORECASE)
+    invoice_pattern = re.compile(r'(invoice|inv|bill|statement)\s*[:#\s]*([a-zA-Z0-9-]{3,20})', re.IGNORECASE)
+    reference_pattern = re.compile(r'(ref|reference|po)\s*[:#\s]*([a-zA-Z0-9-]{3,20})', re.IGNORECASE)
+
+    for line in lines:
+        if not date_str:
+            date_match = date_pattern.search(line)
+            if date_match:
+                date_str = date_match.group(0).replace('/', '-')
+
+        if not amount_str:
+            amount_match = amount_pattern.search(line)
+            if amount_match:
+                amount = amount_match.group(2).replace(',', '')
+                amount_str = f"USD-{amount}"
+
+        if not invoice_str:
+            invoice_match = invoice_pattern.search(line)
+            if invoice_match:
+                invoice_str = invoice_match.group(2).strip().upper().replace(' ', '_')
+
+        if not reference_str and not invoice_str:
+            reference_match = reference_pattern.search(line)
+            if reference_match:
+                reference_str = reference_match.group(2).strip().upper().replace(' ', '_')
+
+        if custom_search_term and not custom_match_str:
+            if custom_search_term.isdigit():
+                match = re.search(f'{custom_search_term}[\\d-]+', line)
+                if match:
+                    custom_match_str = match.group(0)
+            else:
+                pattern = r'[a-zA-Z0-9-]*' + re.escape(custom_search_term) + r'[a-zA-Z0-9-]*'
+                match = re.search(pattern, line, re.IGNORECASE)
+                if match:
+                    custom_match_str = match.group(0).strip()
+
+            if custom_match_str:
+                custom_match_str = re.sub(r'[^a-zA-Z0-9-]', '', custom_match_str).strip('_')
+
+        if targeted_label_term and not targeted_label_str:
+            match = re.search(f'{re.escape(targeted_label_term)}\\s*([^\\n]+)', line, re.IGNORECASE)
+            if match:
+                targeted_label_str = re.sub(r'[^a-zA-Z0-9]', '', match.group(1).strip())
+                if not targeted_label_str:
+                    targeted_label_str = None
+
+        if (date_str and
+            (not custom_search_term or custom_match_str) and
+            (not targeted_label_term or targeted_label_str)):
+            break
+
+    return {
+        'date': date_str,
+        'vendor': vendor_str,
+        'amount': amount_str,
+        'invoice_number': invoice_str,
+        'reference_number': reference_str,
+        'custom_match': custom_match_str,
+        'targeted_label': targeted_label_str
+    }
+
+
+def load_services_without_optional_deps():
+    """Loads a separate copy of app.services as if re2 and pyahocorasick weren't installed."""
+    spec = importlib.util.spec_from_file_location('services_fallback', services.__file__)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch.dict(sys.modules, {'re2': None, 'ahocorasick': None}):
+        spec.loader.exec_module(module)
+    return module
+
+
+# Building blocks for random OCR-like text
+TOKENS = (
+    'Invoice', 'INV', 'inv#', 'bill:', 'Statement', 'ſtatement', 'İnv', 'ref', 'Reference', 'Kref', 'PO', 'po:',
+    'Total', 'TOTAL', 'Amount', 'S', '$', '€', '£', '12/03/2024', '1-2-24', '1,234.56', '12.00', '99,99', '١٢.٣٤',
+    'ABC-123', 'x9', 'Date', 'Lbl', 'lbl:', 'ACME Corp.', '2024', '123-45', ':', '#', '-', '٣',
+)
+SEPARATORS = (' ', ' ', '  ', '\t', '\n', '\n', ' \n ', '', '\xa0', '\x0b', '\x1c', '\r', '\u2003')
+CUSTOM_TERMS = (None, '', 'ABC', '12', 'inv', '#', 'x9', '-', '12/', '٣')
+TARGETED_LABELS = (None, '', 'Lbl', 'lbl:', 'Total', 'ref', 'K')
+
+
+def random_cases(seed, count):
+    """Yields (text, custom_search_term, targeted_label_term) tuples."""
+    rng = random.Random(seed)
+    for _ in range(count):
+        text = ''.join(rng.choice(TOKENS) + rng.choice(SEPARATORS) for _ in range(rng.randint(0, 30)))
+        yield text, rng.choice(CUSTOM_TERMS), rng.choice(TARGETED_LABELS)
+
+
+class MatchesBaselineTest(unittest.TestCase):
+    """extract_metadata must give the same result as the original per-line loop."""
+
+    module = services
+
+    def assertMatchesBaseline(self, text, custom_search_term=None, targeted_label_term=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = self.module.extract_metadata(text, custom_search_term, targeted_label_term)
+        self.assertEqual(
+            result,
+            baseline_extract_metadata(text, custom_search_term, targeted_label_term),
+            msg=repr((text, custom_search_term, targeted_label_term))
+        )
+
+    def test_whitespace_outside_re2s(self):
+        # Python's \s matches these, RE2's doesn't
+        for space in ('\xa0', '\x0b', '\x1c', '\x1f', '\x85', ' ', '　'):
+            self.assertMatchesBaseline(f'ACME\nInvoice:{space}A1234\n')
+            self.assertMatchesBaseline(f'ACME\nRef{space}#{space}PO-778\nInvoice 991\n')
+            self.assertMatchesBaseline(f'ACME\nTotal{space}${space}1{space}234.56\n01/02/2024\n')
+            self.assertMatchesBaseline(f'ACME\nDue: 12/03/2024\nLabel{space}XY-9\n', targeted_label_term='Label')
+
+    def test_non_ascii_digits(self):
+        self.assertMatchesBaseline('ACME\nDate ١٢/٠٣/٢٠٢٤\nTotal ١٬٢٣٤.٥٦\n')
+
+    def test_non_ascii_case_folding(self):
+        # re's IGNORECASE folds these onto ASCII letters
+        self.assertMatchesBaseline('ACME\nINVOICE K-991\nDate 01/02/2024\n', targeted_label_term='K')
+        self.assertMatchesBaseline('ACME\nInvoice A-1\n01/02/2024\nSKU 1\n', custom_search_term='ſ')
+        self.assertMatchesBaseline('ACME\nſtatement A-555 Invoice B-991\n')
+        self.assertMatchesBaseline('ACME\nPO 12345 ſtatement\nInvoice A-991\n')
+
+    def test_custom_match_cleaned_to_nothing(self):
+        # The old loop kept the empty string rather than None
+        self.assertMatchesBaseline('ACME\nNo. # 5\n01/02/2024\n', custom_search_term='#')
+        self.assertMatchesBaseline('ACME\nInvoice ٣٤٥٦٧\n', custom_search_term='٣٤')
+
+    def test_random_text(self):
+        for case in random_cases(seed=1, count=3000):
+            self.assertMatchesBaseline(*case)
+
+    def test_random_text_without_label_scan(self):
+        with mock.patch.object(self.module, '_LABEL_AUTOMATON', None):
+            for case in random_cases(seed=2, count=1000):
+                self.assertMatchesBaseline(*case)
+
+
+class FieldsTest(unittest.TestCase):
+    """Asking for some fields must not change their values."""
+
+    def test_field_subsets(self):
+        for text, custom_search_term, targeted_label_term in random_cases(seed=3, count=300):
+            with contextlib.redirect_stdout(io.StringIO()):
+                full = services.extract_metadata(text, custom_search_term, targeted_label_term)
+                for field in services.METADATA_FIELDS:
+                    # Any iterable of field names is accepted
+                    for fields in ([field], (field, 'vendor'), {field}):
+                        partial = services.extract_metadata(text, custom_search_term, targeted_label_term, fields)
+                        self.assertEqual(partial[field], full[field], msg=repr((text, fields)))
+
+
+class FallbackMatchesBaselineTest(MatchesBaselineTest):
+    """The same checks with the standard re module and no label scan."""
+
+    module = load_services_without_optional_deps()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,7 @@
+# wsgi.py
+
+# Entry point for WSGI servers such as gunicorn. Kept apart from run.py,
+# which the OCR worker processes re-import when they start.
+from app import create_app
+
+app = create_app()